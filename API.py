@@ -1,18 +1,23 @@
 import os
-import json
+import orjson
 import asyncio
-import pandas as pd
-import io
+import csv
+import hashlib
+import functools
+import threading
 from fastapi import FastAPI, WebSocket, WebSocketDisconnect
 from fastapi.middleware.cors import CORSMiddleware
 from fastapi.staticfiles import StaticFiles
 from fastapi.responses import FileResponse
+from guardian_core import (
+    OLLAMA_BASE_URL, MODEL_NAME, NUM_CTX, NUM_PREDICT,
+    find_contract_path, load_contracts, open_vector_store,
+    rag_context, normalize_headers
+)
 
 # --- IMPORTS ---
-from langchain_ollama import ChatOllama, OllamaEmbeddings
-from langchain_chroma import Chroma
-from langchain_text_splitters import CharacterTextSplitter
-from langchain_core.documents import Document
+# LangChain is imported inside the functions that use it, so importing this
+# module (scripts, tooling, worker boot) doesn't pay for loading it
 
 app = FastAPI()
 
@@ -25,8 +30,36 @@ app.add_middleware(
     allow_headers=["*"],
 )
 
-OLLAMA_BASE_URL = os.getenv("OLLAMA_BASE_URL", "http://ollama_service:11434")
-MODEL_NAME = "llama3.2"
+# Identical on every call and sent first, so Ollama can reuse its KV cache
+SYSTEM_PROMPT = """ACT AS: Commercial Auditor.
+TASK: Audit Invoice.
+
+INSTRUCTIONS:
+Compare the Invoice against the Contract.
+- If the amount matches or is valid according to terms, PASS.
+- If the amount is too high, wrong vendor, or missing items, FAIL.
+
+RETURN JSON ONLY: { "status": "PASS" or "FAIL", "reason": "Short explanation (max 10 words)", "action": "APPROVE" or "DISPUTE" }"""
+
+AUDIT_TEMPLATE = """CONTRACT TERMS:
+{context}
+
+INVOICE DATA:
+ID: {invoice_id}
+Vendor: {vendor}
+Items: {line_items}
+Amount: {total_amount}"""
+
+# Passed to Ollama as `format` so decoding can only produce this object
+AUDIT_SCHEMA = {
+    "type": "object",
+    "properties": {
+        "status": {"type": "string", "enum": ["PASS", "FAIL"]},
+        "reason": {"type": "string"},
+        "action": {"type": "string", "enum": ["APPROVE", "DISPUTE"]}
+    },
+    "required": ["status", "reason", "action"]
+}
 
 # Mount static files
 app.mount("/static", StaticFiles(directory="static"), name="static")
@@ -35,18 +68,88 @@ app.mount("/static", StaticFiles(directory="static"), name="static")
 async def read_root():
     return FileResponse('static/index.html')
 
-def load_data():
-    docs = []
-    paths = ["/app/data/contracts", "/app/data/Contracts"]
-    contract_path = next((p for p in paths if os.path.exists(p)), None)
-    
-    if contract_path:
-        for f in os.listdir(contract_path):
-            if f.endswith(".md"):
-                with open(os.path.join(contract_path, f), "r") as file:
-                    docs.append(Document(page_content=file.read(), metadata={"source": f}))
-    
-    invoices = []
+@app.on_event("startup")
+async def preload_model():
+    # Pin the model in Ollama's memory so the first audit doesn't pay the load
+    try:
+        await get_llm().model_copy(update={"num_predict": 1}).ainvoke("ok")
+    except Exception as e:
+        print(f"Model preload failed: {e}")
+
+@app.on_event("startup")
+async def build_contract_index():
+    # Embed the contracts before the first connection, off the event loop
+    try:
+        await asyncio.to_thread(get_vector_store)
+    except Exception as e:
+        print(f"Contract index build failed: {e}")
+
+# Parsed invoices keyed on the CSV's mtime so "run" messages skip re-parsing
+_INVOICE_CACHE = {"path": None, "mtime": 0, "rows": None}
+_INVOICE_LOCK = asyncio.Lock()
+# get_vector_store runs in worker threads; only one of them should build the index
+_VECTOR_STORE_LOCK = threading.Lock()
+
+def contracts_fingerprint():
+    # Cheap change detector for the in-process cache: file names + mtimes, no reads
+    contract_path = find_contract_path()
+    if not contract_path:
+        return None
+    digest = hashlib.sha1()
+    for f in sorted(os.listdir(contract_path)):
+        if f.endswith(".md"):
+            mtime = os.stat(os.path.join(contract_path, f)).st_mtime
+            digest.update(f"{f}:{mtime}".encode())
+    return digest.hexdigest()[:16]
+
+# One client per process: every connection shares its HTTP connection pool
+@functools.lru_cache(maxsize=1)
+def get_llm():
+    from langchain_ollama import ChatOllama
+    return ChatOllama(
+        model=MODEL_NAME,
+        temperature=0,
+        format=AUDIT_SCHEMA,
+        num_ctx=NUM_CTX,
+        num_predict=NUM_PREDICT,
+        keep_alive=-1,
+        base_url=OLLAMA_BASE_URL
+    )
+
+# Built once, like get_llm(), and shared by every prompt
+@functools.lru_cache(maxsize=1)
+def get_system_message():
+    from langchain_core.messages import SystemMessage
+    return SystemMessage(content=SYSTEM_PROMPT)
+
+@functools.lru_cache(maxsize=1)
+def _build_vector_store(fingerprint):
+    # `fingerprint` only keys the lru_cache; the collection is named by content
+    docs = load_contracts()
+    if not docs:
+        return None
+    return open_vector_store(docs)
+
+def get_vector_store():
+    """Shared contract index; only rebuilt when the contract files change."""
+    with _VECTOR_STORE_LOCK:
+        return _build_vector_store(contracts_fingerprint())
+
+def lookup_contracts(query):
+    # The index is fetched per lookup, so open sockets follow a contract change
+    vector_store = get_vector_store()
+    return rag_context(vector_store, query) if vector_store else None
+
+def iter_invoices(path):
+    with open(path, newline='', encoding='utf-8-sig') as f:
+        reader = csv.DictReader(f)
+        if not reader.fieldnames:
+            return
+        # Normalize headers once; every row dict is built with the clean keys
+        reader.fieldnames = normalize_headers(reader.fieldnames)
+        yield from reader
+
+def load_invoices():
     possible_paths = [
         "/app/data/transactions/invoices.csv",
         "/app/data/transactions/Transactions.csv",
@@ -55,130 +158,88 @@ def load_data():
     
     for path in possible_paths:
         if os.path.exists(path):
+            mtime = os.stat(path).st_mtime
+            if _INVOICE_CACHE["path"] == path and _INVOICE_CACHE["mtime"] == mtime:
+                return _INVOICE_CACHE["rows"]
             try:
-                with open(path, 'r', encoding='utf-8-sig') as f:
-                    lines = f.readlines()
-                
-                cleaned_lines = []
-                for line in lines:
-                    line = line.strip()
-                    # Handle CSV quotes roughly if needed, usually pandas handles it well
-                    # but cleaning empty lines helps
-                    if line:
-                        cleaned_lines.append(line)
-                
-                data_str = "\n".join(cleaned_lines)
-                df = pd.read_csv(io.StringIO(data_str), sep=',')
-                # Normalize headers
-                df.columns = df.columns.str.strip().str.lower().str.replace('"', '').str.replace('\ufeff', '')
-                
-                raw_records = df.to_dict('records')
-                for row in raw_records:
-                    # Normalize keys
-                    clean_row = {k.strip().lower(): v for k, v in row.items()}
-                    invoices.append(clean_row)
-                break
+                invoices = list(iter_invoices(path))
+                _INVOICE_CACHE.update(path=path, mtime=mtime, rows=invoices)
+                return invoices
             except Exception as e:
                 print(f"Error loading CSV: {e}")
             
-    return docs, invoices
+    return []
+
+async def get_invoices():
+    # One parse at a time; concurrent connections wait and then hit the cache
+    async with _INVOICE_LOCK:
+        return await asyncio.to_thread(load_invoices)
+
+# Fixed status messages, serialized once
+_ANALYZING = orjson.dumps({"log": "AI Auditor Analyzing...", "type": "info", "active_node": "3"})
+_CYCLE_COMPLETE = orjson.dumps({"log": "Audit Cycle Complete.", "type": "info", "active_node": "6"})
 
 class AsyncGuardian:
     def __init__(self, websocket: WebSocket):
+        from langchain_core.messages import HumanMessage
         self.ws = websocket
-        self.llm = ChatOllama(model=MODEL_NAME, temperature=0, base_url=OLLAMA_BASE_URL)
-        docs, _ = load_data()
-        
-        if docs:
-            embeddings = OllamaEmbeddings(model=MODEL_NAME, base_url=OLLAMA_BASE_URL)
-            splitter = CharacterTextSplitter(chunk_size=1000, chunk_overlap=0)
-            splits = splitter.split_documents(docs)
-            self.vector_store = Chroma.from_documents(
-                documents=splits, 
-                embedding=embeddings, 
-                collection_name="visual_demo_v5" # New collection name to ensure clean slate
-            )
-        else:
-            self.vector_store = None
+        self.llm = get_llm()
+        self._sys_msg = get_system_message()
+        self._human_message = HumanMessage
 
     async def log(self, msg, type="info", active_node=None):
-        await self.ws.send_text(json.dumps({"log": msg, "type": type, "active_node": active_node}))
-        await asyncio.sleep(0.5)
+        await self.ws.send_bytes(orjson.dumps({"log": msg, "type": type, "active_node": active_node}))
 
-    async def run_audit(self, tx):
+    async def prepare_audit(self, tx):
         # Normalize fields
-        inv_id = str(tx.get('invoice_id') or tx.get('invoice id') or "UNKNOWN")
+        inv_id = str(tx.get('invoice_id') or "UNKNOWN")
         vendor = str(tx.get('vendor') or "Unknown")
-        amount = str(tx.get('total_amount') or tx.get('amount') or '0')
-        line_items = str(tx.get('line_items') or tx.get('item') or 'General Services')
+        amount = str(tx.get('total_amount') or '0')
+        line_items = str(tx.get('line_items') or 'General Services')
+        invoice = {"invoice_id": inv_id, "vendor": vendor, "total_amount": amount}
 
         # 1. Send Invoice Data to UI
-        await self.ws.send_text(json.dumps({
-            "invoice": {
-                "invoice_id": inv_id,
-                "vendor": vendor,
-                "total_amount": amount
-            },
-            "active_node": "1"
-        }))
+        await self.ws.send_bytes(orjson.dumps({"invoice": invoice, "active_node": "1"}))
 
         await self.log(f"Ingesting Invoice {inv_id}...", "info", "1")
         await self.log(f"Fetching Contracts for {vendor}...", "info", "2")
         
         # 2. RAG Search
         context = "No contract found."
-        if self.vector_store:
-            try:
-                # Search for both vendor name and line items
-                query = f"{vendor} pricing {line_items}"
-                results = self.vector_store.similarity_search(query, k=2)
-                context = "\n".join([doc.page_content for doc in results])
-                await self.log(f"Found {len(results)} contract clauses.", "success", "2")
-            except Exception as e:
-                await self.log(f"RAG Error: {e}", "error")
-        
-        await self.log("AI Auditor Analyzing...", "info", "3")
-        
-        # 3. LLM Analysis
-        prompt = f"""
-        ACT AS: Commercial Auditor.
-        TASK: Audit Invoice.
-        
-        CONTRACT TERMS:
-        {context}
-        
-        INVOICE DATA:
-        ID: {inv_id}
-        Vendor: {vendor}
-        Items: {line_items}
-        Amount: {amount}
-        
-        INSTRUCTIONS:
-        Compare the Invoice against the Contract. 
-        - If the amount matches or is valid according to terms, PASS.
-        - If the amount is too high, wrong vendor, or missing items, FAIL.
-        
-        RETURN JSON ONLY: {{ "status": "PASS" or "FAIL", "reason": "Short explanation (max 10 words)", "action": "APPROVE" or "DISPUTE" }}
-        """
-        
         try:
-            response = self.llm.invoke(prompt)
-            content = response.content.strip()
-            # Clean up potential markdown code blocks
-            if "```" in content:
-                content = content.split("```json")[-1].split("```")[0].strip()
-            
-            # Find JSON object
-            start = content.find('{')
-            end = content.rfind('}') + 1
-            if start != -1:
-                result = json.loads(content[start:end])
-            else:
-                result = {"status": "FAIL", "reason": "AI Output Error", "action": "DISPUTE"}
+            # Search for both vendor name and line items
+            query = f"{vendor} pricing {line_items}"
+            # Blocking calls (fingerprint stat, embedding, search): keep them off the event loop
+            match = await asyncio.to_thread(lookup_contracts, query)
+            if match:
+                context, found = match
+                await self.log(f"Found {found} contract clauses.", "success", "2")
         except Exception as e:
-            print(e)
-            result = {"status": "FAIL", "reason": "Processing Error", "action": "DISPUTE"}
+            await self.log(f"RAG Error: {e}", "error")
+        
+        # 3. LLM Prompt: shared system prefix + the per-invoice fields
+        prompt = [self._sys_msg, self._human_message(content=AUDIT_TEMPLATE.format_map({
+            "context": context,
+            "invoice_id": inv_id,
+            "vendor": vendor,
+            "line_items": line_items,
+            "total_amount": amount
+        }))]
+        return invoice, prompt
+
+    @staticmethod
+    def parse_result(content):
+        # Decoding is schema-constrained, so the output should be the JSON object itself
+        try:
+            result = orjson.loads(content)
+        except orjson.JSONDecodeError:
+            result = None
+        # report() reads keys, so anything but an object (list, string, null) is an output error
+        if not isinstance(result, dict):
+            return {"status": "FAIL", "reason": "AI Output Error", "action": "DISPUTE"}
+        return result
 
+    async def report(self, result):
         # 4. Routing
         await self.log(f"Result: {result.get('status', 'UNKNOWN')}", "info")
         
@@ -187,7 +248,43 @@ class AsyncGuardian:
         else:
              await self.log(f"DISPUTING: {result.get('reason')}", "error", "5")
         
-        await self.log("Audit Cycle Complete.", "info", "6")
+        await self.ws.send_bytes(_CYCLE_COMPLETE)
+
+    async def run_audit(self, tx):
+        _, prompt = await self.prepare_audit(tx)
+        await self.ws.send_bytes(_ANALYZING)
+        
+        try:
+            # Stream tokens to the UI as they decode; keep the full text for parsing
+            chunks = []
+            async for chunk in self.llm.astream(prompt):
+                if chunk.content:
+                    chunks.append(chunk.content)
+                    await self.ws.send_bytes(orjson.dumps({"token": chunk.content, "type": "stream"}))
+            result = self.parse_result("".join(chunks))
+        except Exception as e:
+            print(e)
+            result = {"status": "FAIL", "reason": "Processing Error", "action": "DISPUTE"}
+
+        await self.report(result)
+
+    async def run_batch(self, invoices, batch_size=8):
+        # Ollama decodes up to OLLAMA_NUM_PARALLEL prompts together, so send them as one batch
+        for start in range(0, len(invoices), batch_size):
+            audits = [await self.prepare_audit(tx) for tx in invoices[start:start + batch_size]]
+            prompts = [prompt for _, prompt in audits]
+            await self.log(f"AI Auditor Analyzing {len(prompts)} invoices...", "info", "3")
+            
+            responses = await self.llm.abatch(prompts, return_exceptions=True)
+            
+            for (invoice, _), response in zip(audits, responses):
+                if isinstance(response, Exception):
+                    print(response)
+                    result = {"status": "FAIL", "reason": "Processing Error", "action": "DISPUTE"}
+                else:
+                    result = self.parse_result(response.content)
+                await self.ws.send_bytes(orjson.dumps({"invoice": invoice}))
+                await self.report(result)
 
 @app.websocket("/ws")
 async def websocket_endpoint(websocket: WebSocket):
@@ -197,16 +294,23 @@ async def websocket_endpoint(websocket: WebSocket):
     
     # Initialize index to 0
     current_index = 0
+    # Warm the cache so the first "run" doesn't pay for the CSV parse
+    await get_invoices()
     
     try:
         while True:
             data = await websocket.receive_text()
-            if data == "run":
-                _, invoices = load_data()
+            if data in ("run", "run_all"):
+                # A cache hit costs one stat(); the CSV is only re-parsed when it changes
+                invoices = await get_invoices()
                 if not invoices:
                     await guardian.log("No CSV data found!", "error")
                     continue
                 
+                if data == "run_all":
+                    await guardian.run_batch(invoices)
+                    continue
+                
                 # Cycle through invoices using modulus operator
                 target = invoices[current_index % len(invoices)]
                 current_index += 1
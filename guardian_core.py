@@ -0,0 +1,127 @@
+import os
+import hashlib
+import functools
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
+
+# Shared by API.py and guardian_demo.py. LangChain is imported inside the
+# functions that use it, so importing this module stays cheap
+
+OLLAMA_BASE_URL = os.getenv("OLLAMA_BASE_URL", "http://ollama_service:11434")
+MODEL_NAME = "llama3.2"
+CHROMA_DIR = "/app/data/chroma_store"
+
+# Larger, section-aligned chunks mean fewer embedding passes at ingestion
+CHUNK_SIZE = 2000
+CHUNK_OVERLAP = 200
+CONTRACT_SEPARATORS = ["\n## ", "\n# ", "\n\n", "\n", " ", ""]
+RAG_K = 2
+NUM_PREDICT = 128
+# Instructions plus invoice fields, with headroom, for either prompt
+PROMPT_TEXT_CHARS = 1536
+
+# One fixed num_ctx for every call, preload included: Ollama reloads the runner
+# whenever it changes. Sized for the largest audit (~3 chars per token)
+NUM_CTX = -(-((PROMPT_TEXT_CHARS + RAG_K * CHUNK_SIZE) // 3 + NUM_PREDICT) // 256) * 256
+
+# --- CSV HEADERS ---
+# Drops quotes and stray BOMs from header names in one pass
+_HEADER_TABLE = str.maketrans({'"': None, '\ufeff': None})
+
+# Header variants seen in exports, mapped to the names the audits read.
+# Listed in priority order: the first variant present wins
+COLUMN_ALIASES = {
+    "invoice id": "invoice_id",
+    "line items": "line_items",
+    "item": "line_items",
+    "total amount": "total_amount",
+    "amount": "total_amount"
+}
+
+def normalize_headers(fieldnames):
+    headers = [h.strip().lower().translate(_HEADER_TABLE) for h in fieldnames]
+    # One rename per canonical column, and none if it's already present:
+    # DictReader keeps the last of duplicate keys, so a second alias would win
+    renames = {}
+    for alias, canonical in COLUMN_ALIASES.items():
+        if alias in headers and canonical not in headers and canonical not in renames.values():
+            renames[alias] = canonical
+    return [renames.get(h, h) for h in headers]
+
+# --- CONTRACTS ---
+def find_contract_path():
+    paths = ["/app/data/contracts", "/app/data/Contracts"]
+    return next((p for p in paths if os.path.exists(p)), None)
+
+def read_contract(path):
+    with open(path, "r") as file:
+        return file.read()
+
+def load_contracts():
+    from langchain_core.documents import Document
+    contract_path = find_contract_path()
+    if not contract_path:
+        return []
+
+    md_files = [f for f in os.listdir(contract_path) if f.endswith(".md")]
+    # Overlap the file reads instead of paying each one's latency in turn
+    with ThreadPoolExecutor(max_workers=8) as ex:
+        texts = list(ex.map(read_contract, [os.path.join(contract_path, f) for f in md_files]))
+    return [Document(page_content=text, metadata={"source": f}) for f, text in zip(md_files, texts)]
+
+def collection_name_for(docs):
+    # Content hash, so a restart or a touched-but-unchanged file reuses the stored index.
+    # The embedding model and chunking settings are part of the key: changing them must re-embed
+    digest = hashlib.sha256(f"{MODEL_NAME}:{CHUNK_SIZE}:{CHUNK_OVERLAP}".encode())
+    for doc in sorted(docs, key=lambda d: d.metadata["source"]):
+        digest.update(doc.metadata["source"].encode())
+        digest.update(doc.page_content.encode())
+    return f"contracts_{digest.hexdigest()[:16]}"
+
+def open_vector_store(docs):
+    """Persistent contract index for `docs`; embeds only when it isn't on disk yet."""
+    from langchain_chroma import Chroma
+    from langchain_text_splitters import RecursiveCharacterTextSplitter
+    vector_store = Chroma(
+        collection_name=collection_name_for(docs),
+        embedding_function=get_embeddings(),
+        persist_directory=CHROMA_DIR
+    )
+    if not vector_store.get(limit=1)["ids"]:
+        splitter = RecursiveCharacterTextSplitter(chunk_size=CHUNK_SIZE, chunk_overlap=CHUNK_OVERLAP, separators=CONTRACT_SEPARATORS)
+        chunks = splitter.split_documents(docs)
+        vector_store.add_documents(chunks, ids=chunk_ids(chunks))
+    return vector_store
+
+def chunk_ids(chunks):
+    # Stable ids, so two processes building the same index at once upsert
+    # the same rows instead of storing every chunk twice
+    seen = Counter()
+    ids = []
+    for chunk in chunks:
+        source = chunk.metadata["source"]
+        ids.append(hashlib.sha256(f"{source}:{seen[source]}:{chunk.page_content}".encode()).hexdigest())
+        seen[source] += 1
+    return ids
+
+# --- OLLAMA ---
+# One client per process, so every lookup reuses its pooled HTTP connections
+@functools.lru_cache(maxsize=1)
+def get_embeddings():
+    from langchain_ollama import OllamaEmbeddings
+    return OllamaEmbeddings(model=MODEL_NAME, base_url=OLLAMA_BASE_URL)
+
+@functools.lru_cache(maxsize=1024)
+def embed_query(query):
+    # Repeated vendor/item queries skip the Ollama embedding round-trip
+    return get_embeddings().embed_query(query)
+
+def search_contracts(vector_store, query):
+    results = vector_store.similarity_search_by_vector(embed_query(query), k=RAG_K)
+    return "\n".join([doc.page_content for doc in results]), len(results)
+
+@functools.lru_cache(maxsize=256)
+def rag_context(vector_store, query):
+    # For the server, where "run" cycles the same invoices on every socket.
+    # Keyed on the store too, so a rebuilt index never serves stale clauses
+    return search_contracts(vector_store, query)
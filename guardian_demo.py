@@ -1,14 +1,18 @@
 import os
-import time
-import pandas as pd
 import io
+import re
+import codecs
+import csv
+import asyncio
 import click
 
 # --- MODERN IMPORTS ---
-from langchain_ollama import ChatOllama, OllamaEmbeddings
-from langchain_chroma import Chroma
-from langchain_text_splitters import CharacterTextSplitter
-from langchain_core.documents import Document
+from langchain_ollama import ChatOllama
+from langchain_core.messages import HumanMessage, SystemMessage
+from guardian_core import (
+    OLLAMA_BASE_URL, MODEL_NAME, NUM_CTX, NUM_PREDICT,
+    load_contracts, open_vector_store, search_contracts, normalize_headers
+)
 
 # --- CONFIG ---
 GREEN = "\033[92m"
@@ -17,29 +21,42 @@ YELLOW = "\033[93m"
 CYAN = "\033[96m"
 RESET = "\033[0m"
 
-OLLAMA_BASE_URL = os.getenv("OLLAMA_BASE_URL", "http://ollama_service:11434")
-MODEL_NAME = "llama3.2"
+# Kept out of the per-invoice message so every prompt starts with the same tokens
+SYSTEM_PROMPT = """ACT AS: Commercial Assurance Auditor.
+TASK: Compare the INVOICE against the CONTRACT terms.
+
+INSTRUCTIONS:
+- Check if the price charged matches the contract rate.
+- Check for volume discounts or shipping errors.
+- Be brief and direct.
+
+OUTPUT FORMAT:
+[STATUS]: PASS or FAIL
+[REASON]: (1 sentence explanation)
+[ACTION]: Approve or Dispute"""
+SYSTEM_MESSAGE = SystemMessage(content=SYSTEM_PROMPT)
+
+AUDIT_TEMPLATE = """CONTRACT TERMS:
+{context}
+
+INVOICE DATA:
+Item: {line_items}
+Total Amount: {total_amount}"""
+
+# Quote wrapping a whole record: one at line start, one at line end
+_RECORD_QUOTE_RE = re.compile(rb'^[ \t]*"|"[ \t]*\r?$', re.M)
 
 class DataLoader:
     @staticmethod
-    def load_contracts():
-        documents = []
-        paths = ["/app/data/contracts", "/app/data/Contracts"]
-        contract_path = next((p for p in paths if os.path.exists(p)), None)
-        
-        if not contract_path:
-            return []
-            
-        for filename in os.listdir(contract_path):
-            if filename.endswith(".md"):
-                path = os.path.join(contract_path, filename)
-                with open(path, "r") as f:
-                    text = f.read()
-                    documents.append(Document(page_content=text, metadata={"source": filename}))
-        return documents
+    def _unwrap_records(data):
+        # Some exports wrap each whole record in quotes; the header shows whether this one does
+        header = data.split(b"\n", 1)[0].strip()
+        if header.startswith(b'"') and header.endswith(b'"') and b"," in header:
+            data = _RECORD_QUOTE_RE.sub(b"", data).replace(b'""', b'"')
+        return data
 
     @staticmethod
-    def load_invoices():
+    def iter_invoices():
         possible_paths = [
             "/app/data/transactions/invoices.csv",
             "/app/data/transactions/Transactions.csv",
@@ -48,109 +65,96 @@ class DataLoader:
         
         for path in possible_paths:
             if os.path.exists(path):
+                yielded = False
                 try:
-                    with open(path, 'r', encoding='utf-8-sig') as f:
-                        lines = f.readlines()
-                    
-                    cleaned_lines = []
-                    for line in lines:
-                        line = line.strip()
-                        if line.startswith('"') and line.endswith('"') and "," in line:
-                             line = line[1:-1].replace('""', '"')
-                        cleaned_lines.append(line)
-                    
-                    data_str = "\n".join(cleaned_lines)
-                    df = pd.read_csv(io.StringIO(data_str), sep=',')
-                    
-                    df.columns = df.columns.str.strip().str.lower().str.replace('"', '').str.replace('\ufeff', '')
-                    
-                    raw_records = df.to_dict('records')
-                    clean_records = []
-                    for row in raw_records:
-                        clean_row = {k.strip().lower(): v for k, v in row.items()}
-                        clean_records.append(clean_row)
-                        
-                    return clean_records
+                    with open(path, 'rb') as f:
+                        data = DataLoader._unwrap_records(f.read().removeprefix(codecs.BOM_UTF8))
+                    reader = csv.DictReader(io.StringIO(data.decode("utf-8"), newline=''))
+                    if not reader.fieldnames:
+                        continue
+                    reader.fieldnames = normalize_headers(reader.fieldnames)
+                    for row in reader:
+                        yielded = True
+                        yield row
+                    return
                 except Exception as e:
                     print(f"{RED}Error reading CSV: {e}{RESET}")
-        return []
+                    # Rows from this file are already out; don't mix in another file's
+                    if yielded:
+                        return
+
+    @staticmethod
+    def load_invoices():
+        return list(DataLoader.iter_invoices())
 
 class CommercialGuardianAgent:
     def __init__(self):
         print(f"{YELLOW}Initializing Neural Engine ({MODEL_NAME})...{RESET}")
-        self.llm = ChatOllama(model=MODEL_NAME, temperature=0, base_url=OLLAMA_BASE_URL)
+        # keep_alive=-1: stay resident between audits instead of unloading after 5 min
+        self.llm = ChatOllama(model=MODEL_NAME, temperature=0, num_ctx=NUM_CTX, num_predict=NUM_PREDICT, keep_alive=-1, base_url=OLLAMA_BASE_URL)
         
-        docs = DataLoader.load_contracts()
+        docs = load_contracts()
         if docs:
-            splitter = CharacterTextSplitter(chunk_size=1000, chunk_overlap=0)
-            splits = splitter.split_documents(docs)
-            embeddings = OllamaEmbeddings(model=MODEL_NAME, base_url=OLLAMA_BASE_URL)
-            self.vector_store = Chroma.from_documents(
-                documents=splits, 
-                embedding=embeddings, 
-                collection_name="demo_contracts_cli_final"
-            )
+            self.vector_store = open_vector_store(docs)
             print(f"{GREEN}Knowledge Base: {len(docs)} Contracts Ingested.{RESET}")
         else:
             print(f"{RED}Warning: No contracts found.{RESET}")
 
-    def audit_transaction(self, tx):
-        inv_id = tx.get('invoice_id') or tx.get('invoice id') or "UNKNOWN"
+    def build_audit(self, tx):
+        inv_id = tx.get('invoice_id') or "UNKNOWN"
         vendor = tx.get('vendor') or "Unknown Vendor"
         
         if inv_id == "UNKNOWN" and vendor == "Unknown Vendor":
-            return
+            return None
 
-        line_items = str(tx.get('line_items') or tx.get('line items') or tx.get('item') or '')
-        amount = str(tx.get('total_amount') or tx.get('total amount') or tx.get('amount') or '0')
+        line_items = str(tx.get('line_items') or '')
+        amount = str(tx.get('total_amount') or '0')
         date = str(tx.get('date') or 'Unknown Date')
         
         # 1. PYTHON HEADER (100% Accurate)
-        print(f"\n{CYAN}========================================{RESET}")
-        print(f"{YELLOW}AUDIT REPORT: {inv_id}{RESET}")
-        print(f"{CYAN}========================================{RESET}")
-        print(f"Vendor:  {vendor}")
-        print(f"Date:    {date}")
-        print(f"Item:    {line_items}")
-        print(f"Amount:  ${amount}")
-        print(f"{CYAN}----------------------------------------{RESET}")
+        header = "\n".join([
+            f"\n{CYAN}========================================{RESET}",
+            f"{YELLOW}AUDIT REPORT: {inv_id}{RESET}",
+            f"{CYAN}========================================{RESET}",
+            f"Vendor:  {vendor}",
+            f"Date:    {date}",
+            f"Item:    {line_items}",
+            f"Amount:  ${amount}",
+            f"{CYAN}----------------------------------------{RESET}"
+        ])
         
         # 2. RAG SEARCH
         query = f"Pricing for {line_items}"
-        results = self.vector_store.similarity_search(query, k=2)
-        context = "\n".join([doc.page_content for doc in results])
-        
-        # 3. AI ANALYSIS (Focused Prompt)
-        prompt = f"""
-        ACT AS: Commercial Assurance Auditor.
-        TASK: Compare the INVOICE against the CONTRACT terms.
-        
-        CONTRACT TERMS: 
-        {context}
+        # Each invoice is audited once per run, so there is no result cache to hit;
+        # invoices for the same item still share the cached query embedding
+        context, _ = search_contracts(self.vector_store, query)
         
-        INVOICE DATA: 
-        Item: {line_items}
-        Total Amount: {amount}
-        
-        INSTRUCTIONS:
-        - Check if the price charged matches the contract rate.
-        - Check for volume discounts or shipping errors.
-        - Be brief and direct.
-        
-        OUTPUT FORMAT:
-        [STATUS]: PASS or FAIL
-        [REASON]: (1 sentence explanation)
-        [ACTION]: Approve or Dispute
-        """
+        # 3. AI ANALYSIS (Focused Prompt): shared system prefix + the per-invoice fields
+        prompt = [SYSTEM_MESSAGE, HumanMessage(content=AUDIT_TEMPLATE.format_map({
+            "context": context,
+            "line_items": line_items,
+            "total_amount": amount
+        }))]
+        return header, prompt
+
+    async def audit_transactions(self, transactions, batch_size=8):
+        audits = [audit for audit in map(self.build_audit, transactions) if audit]
         
-        try:
+        # One request per batch; the server runs them side by side (OLLAMA_NUM_PARALLEL)
+        for start in range(0, len(audits), batch_size):
+            batch = audits[start:start + batch_size]
+            prompts = [prompt for _, prompt in batch]
             print("Analyzing...", end="\r")
-            response = self.llm.invoke(prompt)
-            # Clean up response slightly
-            clean_response = response.content.replace("**", "").strip()
-            print(f"{clean_response}\n")
-        except Exception as e:
-            print(f"{RED}AI Error: {e}{RESET}")
+            responses = await self.llm.abatch(prompts, return_exceptions=True)
+            
+            for (header, _), response in zip(batch, responses):
+                print(header)
+                if isinstance(response, Exception):
+                    print(f"{RED}AI Error: {response}{RESET}")
+                    continue
+                # Clean up response slightly
+                clean_response = response.content.replace("**", "").strip()
+                print(f"{clean_response}\n")
 
 @click.command()
 def run():
@@ -162,9 +166,7 @@ def run():
         return
 
     print(f"Processing {len(transactions)} transactions...")
-    for tx in transactions:
-        agent.audit_transaction(tx)
-        time.sleep(0.5)
+    asyncio.run(agent.audit_transactions(transactions))
 
 if __name__ == "__main__":
     run()
\ No newline at end of file
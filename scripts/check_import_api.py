@@ -1,7 +1,10 @@
-import importlib, traceback
+import os, py_compile, traceback
+
+# Compile only: importing API would execute it, and LangChain is loaded lazily anyway
+API_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'API.py')
 
 try:
-    importlib.import_module('API')
-    print('Imported API module successfully')
+    py_compile.compile(API_PATH, doraise=True)
+    print('Compiled API module successfully')
 except Exception:
-    traceback.print_exc()
\ No newline at end of file
+    traceback.print_exc()
@@ -0,0 +1,37 @@
+import csv
+import io
+import os
+import sys
+from types import SimpleNamespace
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from guardian_core import chunk_ids, normalize_headers
+
+
+def test_first_alias_wins_for_each_column():
+    assert normalize_headers(['Line Items', 'Item', 'Amount']) == ['line_items', 'item', 'total_amount']
+
+
+def test_canonical_column_is_not_shadowed_by_an_alias():
+    assert normalize_headers(['line_items', 'Item', '"Total Amount"']) == ['line_items', 'item', 'total_amount']
+
+
+def test_quotes_and_bom_are_stripped():
+    assert normalize_headers(['\ufeff"Invoice ID"', ' Vendor ']) == ['invoice_id', 'vendor']
+
+
+def test_dict_reader_keeps_the_preferred_column():
+    reader = csv.DictReader(io.StringIO('Line Items,Item,Amount\nWidgets,Other,10\n'))
+    reader.fieldnames = normalize_headers(reader.fieldnames)
+    row = next(reader)
+    assert row['line_items'] == 'Widgets'
+    assert row['total_amount'] == '10'
+
+
+def test_chunk_ids_are_stable_and_unique():
+    chunks = [SimpleNamespace(metadata={'source': source}, page_content='Rate: $10')
+              for source in ('a.md', 'a.md', 'b.md')]
+    ids = chunk_ids(chunks)
+    assert len(set(ids)) == 3
+    assert ids == chunk_ids(chunks)